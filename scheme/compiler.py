@@ -0,0 +1,310 @@
+import hashlib
+import os
+import pickle
+import sys
+from array import array
+from functools import lru_cache
+
+from .opcodes import (LOAD_CONST, LOAD_GLOBAL, LOAD_LOCAL, CALL_BUILTIN, CALL,
+                      MAKE_LAMBDA, DEFINE, POP, RET, ADD, SUB, MUL,
+                      ADD_LOCAL_CONST, SUB_LOCAL_CONST, MUL_LOCAL_CONST,
+                      ADD_LOCAL_LOCAL, SUB_LOCAL_LOCAL, MUL_LOCAL_LOCAL)
+from .scheme import (is_numeric_literal, is_string_literal,
+                     is_valid_variable_name,
+                     evaluate_numeric_literal, evaluate_string_literal,
+                     get_builtin, BUILTIN_INDEX, BUILTIN_NAMES)
+
+# where compiled bytecode is stored between runs. The disk cache is off unless this is set;
+# only point it at a directory you trust, since entries are unpickled.
+CACHE_DIR = os.environ.get('SCHEME_CACHE_DIR') or None
+# max number of entries kept in CACHE_DIR; the oldest are removed beyond this
+CACHE_MAX_ENTRIES = 4096
+# CACHE_DIR is scanned for entries to remove once every this many writes
+CACHE_PRUNE_INTERVAL = 256
+_writes_since_prune = 0
+# bump whenever the bytecode format changes, to invalidate old cache entries
+CACHE_VERSION = 3
+
+# builtins which the VM computes inline, rather than calling through BUILTINS
+ARITHMETIC_OPS = {'+': ADD, '-': SUB, '*': MUL}
+# single-instruction forms of (op local num) and (op local local)
+LOCAL_CONST_OPS = {'+': ADD_LOCAL_CONST, '-': SUB_LOCAL_CONST, '*': MUL_LOCAL_CONST}
+LOCAL_LOCAL_OPS = {'+': ADD_LOCAL_LOCAL, '-': SUB_LOCAL_LOCAL, '*': MUL_LOCAL_LOCAL}
+
+class Code:
+    """ A flat block of bytecode, with the constants and names it refers to."""
+
+    def __init__(self):
+        self.consts = []
+        self.names = []
+        self.ops = array('i')
+        # whether the result depends only on the local values it is run with
+        self.pure = False
+
+    def add_const(self, value):
+        self.consts.append(value)
+        return len(self.consts) - 1
+
+    def add_name(self, name):
+        try:
+            return self.names.index(name)
+        except ValueError:
+            self.names.append(name)
+            return len(self.names) - 1
+
+    def emit(self, *ops):
+        self.ops.extend(ops)
+
+# token kinds. Literal and builtin tokens double as the AST nodes for themselves.
+NUM = 'num'
+STR = 'str'
+BUILTIN = 'builtin'
+SYM = 'sym'
+OPEN = '('
+CLOSE = ')'
+DEFINE_TOKEN = (BUILTIN, 'define')
+
+def classify(word):
+    """ Returns: the (kind, value) token for a word of source."""
+    if word == '(' or word == ')':
+        return (word, word)
+    if is_numeric_literal(word):
+        return (NUM, evaluate_numeric_literal(word))
+    if is_string_literal(word):
+        return (STR, evaluate_string_literal(word))
+    if word in BUILTIN_NAMES:
+        return (BUILTIN, word)
+    return (SYM, sys.intern(word))
+
+def tokenize(src):
+    """ Split scheme source into a flat list of (kind, value) tokens.
+        Names are interned, so they compare and hash as cheaply as possible in environments."""
+    return [classify(w) for w in src.replace('(', ' ( ').replace(')', ' ) ').split()]
+
+def read_from(tokens):
+    """ Assemble a list of tokens into nested lists, one per compound expression.
+        Returns: list of top-level expressions"""
+    stack = [[]]
+    for tok in tokens:
+        kind = tok[0]
+        if kind == OPEN:
+            stack.append([])
+        elif kind == CLOSE:
+            if len(stack) == 1:
+                raise SyntaxError("Imbalanced parentheses")
+            exp = stack.pop()
+            stack[-1].append(exp)
+        else:
+            stack[-1].append(tok)
+    if len(stack) != 1:
+        raise SyntaxError("Imbalanced parentheses")
+    return stack[0]
+
+class Resolver:
+    """ Builds AST nodes, resolving each variable name either to a slot in the enclosing
+        function's argument list or to a lookup in the environment."""
+
+    def __init__(self, params=()):
+        """ `params`: argument names of the function being compiled, if any."""
+        self.slots = {name: i for i, name in enumerate(params)}
+
+    def resolve(self, name):
+        idx = self.slots.get(name)
+        if idx is None:
+            return ('global', name)
+        return ('local', idx)
+
+    def build_define(self, exp):
+        """ Build the node for a `define` expression, given its (unevaluated) words."""
+        if len(exp) != 3:
+            raise SyntaxError(f"The 'define' keyword takes two args")
+        name, body = exp[1], exp[2]
+        # a function is being defined
+        if isinstance(name, list):
+            if len(name) == 0 or not all(isinstance(w, tuple) and w[0] == SYM for w in name):
+                raise SyntaxError("Invalid function signature")
+            name, args = name[0][1], tuple(w[1] for w in name[1:])
+            return ('define', name, ('lambda', args, Resolver(args).build(body)))
+        if name[0] != SYM or not is_valid_variable_name(name[1]):
+            raise SyntaxError(f"{name[1]} is not a valid variable name")
+        return ('define', name[1], self.build(body))
+
+    def build(self, exp):
+        """ Build the AST node for a single token or nested list of tokens."""
+        if isinstance(exp, list):
+            if len(exp) == 0:
+                return ('nil',)
+            # a compound expression of one word is just that word's value, eg `(4)` or `(f)`
+            if len(exp) == 1:
+                return self.build(exp[0])
+            if exp[0] == DEFINE_TOKEN:
+                return self.build_define(exp)
+            op, args = exp[0], exp[1:]
+            return ('call', self.build(op), tuple(self.build(a) for a in args))
+        if exp[0] == SYM:
+            return self.resolve(exp[1])
+        return exp
+
+@lru_cache(maxsize=4096)
+def compile(src, params=()):
+    """ Compile the scheme source `src` into an AST.
+        `params`: if compiling a function body, the names of its arguments.
+        Nodes are tagged tuples:
+            ('nil',)
+            ('num', value)
+            ('str', value)
+            ('builtin', name)
+            ('local', index)
+            ('global', name)
+            ('call', op_node, arg_nodes)
+            ('define', name, body_node)
+            ('lambda', args, body_node)
+            ('seq', nodes)
+        Nodes are immutable, so results are cached and shared between callers with the same source.
+        """
+    exps = read_from(tokenize(src))
+    resolver = Resolver(params)
+    if len(exps) == 0:
+        return ('nil',)
+    if len(exps) == 1:
+        return resolver.build(exps[0])
+    return ('seq', tuple(resolver.build(e) for e in exps))
+
+def is_pure(node):
+    """ True if the node's value depends only on constants and function arguments, and
+        evaluating it has no side effects: no `define`, no global names, no calls other than
+        to builtins."""
+    tag = node[0]
+    if tag in ('nil', 'num', 'str', 'builtin', 'local'):
+        return True
+    if tag == 'call':
+        return node[1][0] == 'builtin' and node[1][1] != 'define' and all(is_pure(a) for a in node[2])
+    if tag == 'seq':
+        return all(is_pure(n) for n in node[1])
+    return False
+
+def _emit_superinstruction(name, args, code):
+    """ Emit a single instruction for a two-argument arithmetic call on function arguments
+        and numeric constants, if there is one.
+        Returns: True if an instruction was emitted."""
+    if name not in LOCAL_CONST_OPS or len(args) != 2:
+        return False
+    a, b = args
+    # + and * on numbers commute, so constants may come first
+    if name != '-' and a[0] == 'num' and b[0] == 'local':
+        a, b = b, a
+    if a[0] == 'local' and b[0] == 'num':
+        code.emit(LOCAL_CONST_OPS[name], a[1], code.add_const(b[1]))
+        return True
+    if a[0] == 'local' and b[0] == 'local':
+        code.emit(LOCAL_LOCAL_OPS[name], a[1], b[1])
+        return True
+    return False
+
+def _emit(node, code):
+    """ Append the bytecode for `node` to `code`."""
+    tag = node[0]
+    if tag == 'num' or tag == 'str':
+        code.emit(LOAD_CONST, code.add_const(node[1]))
+    elif tag == 'nil':
+        code.emit(LOAD_CONST, code.add_const(None))
+    elif tag == 'local':
+        code.emit(LOAD_LOCAL, node[1])
+    elif tag == 'global':
+        code.emit(LOAD_GLOBAL, code.add_name(node[1]))
+    elif tag == 'builtin':
+        code.emit(LOAD_CONST, code.add_const(get_builtin(node[1])))
+    elif tag == 'call':
+        op, args = node[1], node[2]
+        if op[0] == 'builtin':
+            if _emit_superinstruction(op[1], args, code):
+                return
+            for a in args:
+                _emit(a, code)
+            if op[1] in ARITHMETIC_OPS:
+                code.emit(ARITHMETIC_OPS[op[1]], len(args))
+            else:
+                code.emit(CALL_BUILTIN, BUILTIN_INDEX[op[1]], len(args))
+        else:
+            _emit(op, code)
+            for a in args:
+                _emit(a, code)
+            code.emit(CALL, len(args))
+    elif tag == 'define':
+        _emit(node[2], code)
+        code.emit(DEFINE, code.add_name(node[1]))
+    elif tag == 'lambda':
+        code.emit(MAKE_LAMBDA, code.add_const((node[1], compile_to_bc(node[2]))))
+    elif tag == 'seq':
+        for i, n in enumerate(node[1]):
+            if i > 0:
+                code.emit(POP)
+            _emit(n, code)
+    else:
+        raise SyntaxError(f"Unknown node type {tag}")
+
+def compile_to_bc(node, code=None):
+    """ Lower an AST node to bytecode.
+        Returns: a Code object which leaves the node's value on the stack and returns it."""
+    if code is None:
+        code = Code()
+    _emit(node, code)
+    code.emit(RET)
+    code.pure = is_pure(node)
+    return code
+
+def _intern_names(code):
+    """ Re-intern the names in unpickled bytecode, including that of the functions it defines."""
+    code.names = [sys.intern(n) for n in code.names]
+    for i, c in enumerate(code.consts):
+        if isinstance(c, tuple) and len(c) == 2 and isinstance(c[1], Code):
+            args, body = c
+            code.consts[i] = (tuple(map(sys.intern, args)), body)
+            _intern_names(body)
+
+def _prune_cache():
+    """ Remove the oldest entries from CACHE_DIR, leaving at most CACHE_MAX_ENTRIES.
+        The directory may exceed that by up to CACHE_PRUNE_INTERVAL entries between prunes."""
+    entries = [e for e in os.scandir(CACHE_DIR) if e.name.endswith('.pkl')]
+    if len(entries) <= CACHE_MAX_ENTRIES:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for e in entries[:len(entries) - CACHE_MAX_ENTRIES]:
+        os.remove(e.path)
+
+def _count_write():
+    """ Record a write to CACHE_DIR, pruning it every CACHE_PRUNE_INTERVAL writes."""
+    global _writes_since_prune
+    _writes_since_prune += 1
+    if _writes_since_prune >= CACHE_PRUNE_INTERVAL:
+        _writes_since_prune = 0
+        _prune_cache()
+
+@lru_cache(maxsize=4096)
+def compile_cached(src):
+    """ Compile the scheme source `src` to bytecode, remembering the result in memory.
+        If CACHE_DIR is set, compiled code is also stored there, keyed by a hash of the source;
+        the disk cache is skipped if it can't be read or written."""
+    if CACHE_DIR is None:
+        return compile_to_bc(compile(src))
+    key = hashlib.blake2b(f"{CACHE_VERSION}:{src}".encode(), digest_size=16).hexdigest()
+    path = os.path.join(CACHE_DIR, key + '.pkl')
+    try:
+        with open(path, 'rb') as f:
+            code = pickle.load(f)
+        _intern_names(code)
+        return code
+    except Exception:
+        # missing, unreadable, or stale entries are recompiled and overwritten
+        pass
+    code = compile_to_bc(compile(src))
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            pickle.dump(code, f)
+        os.replace(tmp, path)
+        _count_write()
+    except OSError:
+        pass
+    return code
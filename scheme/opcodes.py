@@ -0,0 +1,25 @@
+""" Opcodes for the bytecode VM.
+    Each opcode is followed in the instruction stream by its integer operands, listed below.
+    Opcodes marked 'quickened' are never emitted by the compiler; the VM rewrites a generic
+    opcode into one of these in place, once it has seen what the instruction operates on."""
+
+LOAD_CONST = 0      # const_idx
+LOAD_GLOBAL = 1     # name_idx
+CALL_BUILTIN = 2    # builtin_idx nargs
+CALL = 3            # nargs
+MAKE_LAMBDA = 4     # const_idx
+DEFINE = 5          # name_idx
+POP = 6
+RET = 7
+LOAD_LOCAL = 8      # slot_idx
+ADD = 9             # nargs
+SUB = 10            # nargs
+MUL = 11            # nargs
+CALL_LAMBDA = 12    # nargs (quickened CALL)
+# superinstructions for two-argument arithmetic on function arguments
+ADD_LOCAL_CONST = 13    # slot_idx const_idx
+SUB_LOCAL_CONST = 14    # slot_idx const_idx
+MUL_LOCAL_CONST = 15    # slot_idx const_idx
+ADD_LOCAL_LOCAL = 16    # slot_idx slot_idx
+SUB_LOCAL_LOCAL = 17    # slot_idx slot_idx
+MUL_LOCAL_LOCAL = 18    # slot_idx slot_idx
@@ -1,13 +1,76 @@
 import re
+import sys
+
+from .opcodes import (LOAD_CONST, LOAD_GLOBAL, LOAD_LOCAL, CALL_BUILTIN, CALL, CALL_LAMBDA,
+                      MAKE_LAMBDA, DEFINE, POP, RET, ADD, SUB, MUL,
+                      ADD_LOCAL_CONST, SUB_LOCAL_CONST, MUL_LOCAL_CONST,
+                      ADD_LOCAL_LOCAL, SUB_LOCAL_LOCAL, MUL_LOCAL_LOCAL)
+
+class Frame:
+    """ The local environment of a function call: its own bindings, plus a reference to
+        the environment it was called from. Lookups fall through to the parent; definitions
+        go in the frame itself.
+        Arguments are read straight from the call's names and values, so a call that
+        defines nothing allocates no dict."""
+    __slots__ = ('names', 'values', 'locals', 'parent')
+
+    def __init__(self, names, values, parent):
+        """ `names`: tuple of argument names
+            `values`: list of argument values, in the same order. Redefining an argument
+                      writes to this list.
+            `parent`: the calling environment"""
+        self.names = names
+        self.values = values
+        self.locals = None
+        self.parent = parent
+
+    def __getitem__(self, name):
+        frame = self
+        while type(frame) is Frame:
+            if frame.locals is not None and name in frame.locals:
+                return frame.locals[name]
+            if name in frame.names:
+                return frame.values[frame.names.index(name)]
+            frame = frame.parent
+        return frame[name]
+
+    def __setitem__(self, name, value):
+        # arguments are rebound in place, so that the VM's LOAD_LOCAL sees the new value
+        if name in self.names:
+            self.values[self.names.index(name)] = value
+            return
+        if self.locals is None:
+            self.locals = {}
+        self.locals[name] = value
+
+# whether functions with pure bodies memoize their results. Off by default: a lookup only
+# pays for itself when calls repeat the same arguments, and a miss costs about twice an
+# unmemoized call.
+MEMOIZE = False
+# max number of results remembered for each pure function
+MEMO_SIZE = 1024
+
+def memo_key(arg_values):
+    """ Key under which a call's result is memoized.
+        Values of different types are kept apart (eg 1 and 1.0), and floats are keyed by
+        repr, so that eg -0.0 and 0.0 are too."""
+    return tuple((type(a), repr(a) if type(a) is float else a) for a in arg_values)
 
 class Lambda:
-    """ represents a lambda function """
+    """ represents a lambda function.
+        If MEMOIZE is set and the body is pure (see compiler.is_pure), results are memoized
+        by argument values. """
     
     def __init__(self, args, expression):
         """ `args`: a list of arguments to the function. Each is a string
-            `expression`: a valid scheme expression which defines the action of the function. eg `(+ x 2)` """
-        self.args = args
+            `expression`: a valid scheme expression which defines the action of the function. eg `(+ x 2)`
+                          May also be given as already-compiled bytecode. """
+        self.args = tuple(map(sys.intern, args))
         self.expression = expression
+        if isinstance(expression, str):
+            expression = compiler.compile_to_bc(compiler.compile(expression, self.args))
+        self.code = expression
+        self.memo = {} if MEMOIZE and self.code.pure else None
 
     def evaluate(self, arg_values, env):
         """ Evaluates the function at the argument values provided, in the environment provided. 
@@ -16,11 +79,23 @@ class Lambda:
         """
         if len(arg_values) != len(self.args):
             raise ValueError(f"Expected {len(self.args)} args, received {len(arg_values)}")
-        args_to_values = { arg: val for arg, val in zip(self.args, arg_values)}
-        # build a local environment
-        local_env = {**env}
-        local_env.update(args_to_values)
-        return evaluate(self.expression, local_env)
+        # the frame may rebind arguments in this list, so don't share the caller's
+        arg_values = list(arg_values)
+        if self.memo is None:
+            return run(self.code, Frame(self.args, arg_values, env), arg_values)
+        key = memo_key(arg_values)
+        try:
+            return self.memo[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable arguments can't be remembered
+            return run(self.code, Frame(self.args, arg_values, env), arg_values)
+        result = run(self.code, Frame(self.args, arg_values, env), arg_values)
+        if len(self.memo) >= MEMO_SIZE:
+            del self.memo[next(iter(self.memo))]
+        self.memo[key] = result
+        return result
 
     def __call__(self, arg_values, env):
         return self.evaluate(arg_values, env)
@@ -35,20 +110,22 @@ def sweep_for(expression, seeking, incr):
 
         """
     if incr == 1:
-        return expression.index(seeking)
+        i = expression.find(seeking)
     elif incr == -1:
-        return len(expression) - 1 - expression[::-1].index(seeking)
-    raise ValueError
+        i = expression.rfind(seeking)
+    else:
+        raise ValueError
+    if i == -1:
+        raise ValueError(f"{seeking} not found")
+    return i
 
 def strip(expression):
     """Removes the outermost parentheses."""
-    try:
-        i_open = sweep_for(expression, '(', +1)
-    except ValueError:
+    i_open = expression.find('(')
+    if i_open == -1:
         raise SyntaxError("Expecting (")
-    try:
-        i_close = sweep_for(expression, ')', -1)
-    except ValueError:
+    i_close = expression.rfind(')')
+    if i_close == -1:
         raise SyntaxError("Expecting )")
     return expression[i_open+1:i_close]
 
@@ -56,15 +133,8 @@ def is_potential_compound(exp):
     return '(' in exp and ')' in exp
 
 def is_numeric_literal(expression):
-    if len(expression) == 0:
-        return False
-    if re.match(r"[^.0-9]", expression):
-        return False
-    if re.match(r"^\s*\.\s*$", expression):
-        return False
-    if re.match(r"^\s*\d*(\.)?\d*\s*$", expression):
-        return True
-    return False
+    """ True if the expression is an integer or decimal literal, eg `2`, `2.5`, `.5`"""
+    return expression.isascii() and expression.replace('.', '', 1).isdecimal()
 
 def add(args, env):
     return sum(args)
@@ -85,9 +155,13 @@ BUILTIN_OPS = {'+': add,
                '-': sub, 
                '*': mul,
                'define': define}
+# indexed forms of the builtins, for the bytecode VM
+BUILTINS = list(BUILTIN_OPS.values())
+BUILTIN_INDEX = {name: i for i, name in enumerate(BUILTIN_OPS)}
+BUILTIN_NAMES = frozenset(BUILTIN_OPS)
 
 def is_builtin(exp):
-    return exp in BUILTIN_OPS.keys()
+    return exp in BUILTIN_OPS
 
 def get_builtin(exp):
     return BUILTIN_OPS[exp]
@@ -101,7 +175,7 @@ def is_primitive(expression):
     return is_numeric_literal(expression) or is_string_literal(expression) or len(expression) == 0
 
 def is_function(obj):
-    return hasattr(obj, "__call__")
+    return callable(obj)
 
 def evaluate_numeric_literal(exp):
     if '.' in exp:
@@ -159,7 +233,7 @@ def parse(expression):
     skip_chars = [' ', '\t', '\n']
     delimiters = (*skip_chars, start_token, end_token)
     words = []
-    word = ''
+    buf = []
     depth = 0
     next_depth = 0
     for i in range(len(expression)):
@@ -172,12 +246,12 @@ def parse(expression):
             next_depth = depth
 
         if depth > 0 or t not in skip_chars:
-            word += t
+            buf.append(t)
         if depth == 0:
             next_terminates = i== (len(expression)-1) or expression[i+1] in delimiters
             if t == end_token or t not in delimiters and next_terminates:
-                words.append(word)
-                word = ''
+                words.append(''.join(buf))
+                buf.clear()
 
         depth = next_depth
 
@@ -198,10 +272,12 @@ def combine(results, env):
             return op(args, env)
         return args[-1]
 
+VARIABLE_NAME_RE = re.compile(r"^\w*$")
+
 def is_valid_variable_name(name):
     if is_builtin(name):
         return False
-    if re.match(r"^\w*$", name):
+    if VARIABLE_NAME_RE.match(name):
         return True
     return False
 
@@ -240,16 +316,131 @@ def evaluate_words(expression, env):
 def is_function_call(expression):
     return expression[0] == '(' and expression[-1] == ')'
 
+def run(code, env, local_values=()):
+    """ Execute compiled bytecode in the given environment.
+        `local_values`: argument values of the function being run, indexed by slot
+        Returns: the value left on the stack by RET."""
+    consts, names, ops = code.consts, code.names, code.ops
+    stack = []
+    pc = 0
+    # state of the callers suspended by CALL_LAMBDA, so that lambda calls don't recurse in python
+    calls = []
+    while True:
+        op = ops[pc]
+        if op == LOAD_CONST:
+            stack.append(consts[ops[pc+1]])
+            pc += 2
+        elif op == LOAD_LOCAL:
+            stack.append(local_values[ops[pc+1]])
+            pc += 2
+        elif op == ADD_LOCAL_CONST:
+            stack.append(local_values[ops[pc+1]] + consts[ops[pc+2]])
+            pc += 3
+        elif op == SUB_LOCAL_CONST:
+            stack.append(local_values[ops[pc+1]] - consts[ops[pc+2]])
+            pc += 3
+        elif op == MUL_LOCAL_CONST:
+            stack.append(local_values[ops[pc+1]] * consts[ops[pc+2]])
+            pc += 3
+        elif op == ADD_LOCAL_LOCAL:
+            # start from 0 like sum(), so that eg strings are rejected as they are by ADD
+            stack.append(0 + local_values[ops[pc+1]] + local_values[ops[pc+2]])
+            pc += 3
+        elif op == SUB_LOCAL_LOCAL:
+            # subtract (0 + y) like SUB does, so that eg -0.0 - -0.0 gives the same result
+            stack.append(local_values[ops[pc+1]] - (0 + local_values[ops[pc+2]]))
+            pc += 3
+        elif op == MUL_LOCAL_LOCAL:
+            stack.append(local_values[ops[pc+1]] * local_values[ops[pc+2]])
+            pc += 3
+        elif op == LOAD_GLOBAL:
+            stack.append(lookup_variable(names[ops[pc+1]], env))
+            pc += 2
+        elif op == ADD:
+            base = len(stack) - ops[pc+1]
+            s = sum(stack[base:])
+            del stack[base:]
+            stack.append(s)
+            pc += 2
+        elif op == SUB:
+            base = len(stack) - ops[pc+1]
+            s = stack[base] - sum(stack[base+1:])
+            del stack[base:]
+            stack.append(s)
+            pc += 2
+        elif op == MUL:
+            base = len(stack) - ops[pc+1]
+            p = 1
+            for i in range(base, len(stack)):
+                p *= stack[i]
+            del stack[base:]
+            stack.append(p)
+            pc += 2
+        elif op == CALL_BUILTIN:
+            n = ops[pc+2]
+            base = len(stack) - n
+            args = stack[base:]
+            del stack[base:]
+            stack.append(BUILTINS[ops[pc+1]](args, env))
+            pc += 3
+        elif op == CALL_LAMBDA:
+            base = len(stack) - ops[pc+1]
+            fn = stack[base-1]
+            if type(fn) is not Lambda:
+                # guard failed: the call site has seen something other than a lambda
+                ops[pc] = CALL
+                continue
+            args = stack[base:]
+            del stack[base-1:]
+            if fn.memo is not None:
+                stack.append(fn.evaluate(args, env))
+                pc += 2
+                continue
+            if len(args) != len(fn.args):
+                raise ValueError(f"Expected {len(fn.args)} args, received {len(args)}")
+            calls.append((consts, names, ops, pc + 2, stack, env, local_values))
+            consts, names, ops = fn.code.consts, fn.code.names, fn.code.ops
+            env = Frame(fn.args, args, env)
+            local_values = args
+            stack = []
+            pc = 0
+        elif op == CALL:
+            base = len(stack) - ops[pc+1]
+            fn = stack[base-1]
+            if type(fn) is Lambda:
+                # quicken this call site and dispatch again
+                ops[pc] = CALL_LAMBDA
+                continue
+            args = stack[base:]
+            del stack[base-1:]
+            if is_function(fn):
+                stack.append(fn(args, env))
+            else:
+                stack.append(args[-1] if args else fn)
+            pc += 2
+        elif op == MAKE_LAMBDA:
+            stack.append(Lambda(*consts[ops[pc+1]]))
+            pc += 2
+        elif op == DEFINE:
+            env[names[ops[pc+1]]] = stack[-1]
+            pc += 2
+        elif op == POP:
+            stack.pop()
+            pc += 1
+        elif op == RET:
+            result = stack.pop()
+            if not calls:
+                return result
+            consts, names, ops, pc, stack, env, local_values = calls.pop()
+            stack.append(result)
+        else:
+            raise SyntaxError(f"Unknown opcode {op}")
+
 def evaluate(expression, env):
     """ Evaluate expression in the given environment
     """
-    
-    if is_function_call(expression):
-        expression = strip(expression)
-        inner_words = evaluate_words(expression, env)
-        return combine(inner_words, env)
-    
-    results = evaluate_words(expression, env)
-    if len(results) == 0:
-        return []
-    return results[-1]
\ No newline at end of file
+    return run(compiler.compile_cached(expression), env)
+
+# the compiler imports this module, so it is imported last; its functions are looked up
+# as attributes at call time
+from . import compiler
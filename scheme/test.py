@@ -1,5 +1,11 @@
 import unittest
 
+def setUpModule():
+    # never read or write the on-disk bytecode cache from tests
+    from . import compiler
+    compiler.CACHE_DIR = None
+    compiler.compile_cached.cache_clear()
+
 class TestEvaluatePrimitives(unittest.TestCase):
 
     def test_is_potential_compound(self):
@@ -11,8 +17,8 @@ class TestEvaluatePrimitives(unittest.TestCase):
 
     def test_is_numeric_literal(self):
         from .scheme import is_numeric_literal
-        exprs = ['a', '.', '', '2', '2a', '2.B', '75.603', '3.4.5']
-        targets = [False, False, False, True, False, False, True, False]
+        exprs = ['a', '.', '', '2', '2a', '2.B', '75.603', '3.4.5', '\u0663', '2.\u0663']
+        targets = [False, False, False, True, False, False, True, False, False, False]
         for e, t in zip(exprs, targets):
             self.assertEqual(is_numeric_literal(e), t)
 
@@ -134,6 +140,18 @@ class TestEvaluate(unittest.TestCase):
 
 class TestLambda(unittest.TestCase):
 
+    def test_frame(self):
+        from .scheme import Frame
+        env = {'a': 1, 'b': 2}
+        frame = Frame(('b',), [3], Frame(('c', 'b'), [4, 6], env))
+        self.assertEqual([frame[n] for n in 'abc'], [1, 3, 4])
+        frame['a'] = 5
+        frame['b'] = 7
+        self.assertEqual([frame[n] for n in 'abc'], [5, 7, 4])
+        self.assertEqual(env['a'], 1)
+        with self.assertRaises(KeyError):
+            frame['d']
+
     def test_evaluate(self):
         from .scheme import Lambda
         args = ['x']
@@ -154,5 +172,216 @@ class TestLambda(unittest.TestCase):
         with self.assertRaises(ValueError):
             f([3, 4], env)
 
+    def test_memo(self):
+        from . import scheme
+        from .scheme import evaluate, Lambda
+        env = {}
+        self.assertIsNone(evaluate("(define (f x y) (* x (+ y 1)))", env).memo)
+        scheme.MEMOIZE = True
+        try:
+            f = evaluate("(define (f x y) (* x (+ y 1)))", env)
+            self.assertEqual(f.memo, {})
+            self.assertEqual(evaluate("(f 2 3)", env), 8)
+            self.assertEqual(evaluate("(f 2 3)", env), 8)
+            self.assertEqual(len(f.memo), 1)
+            r = evaluate("(f 2 3.0)", env)
+            self.assertEqual(r, 8)
+            self.assertIsInstance(r, float)
+            g = evaluate("(define (g x) (* x 1))", env)
+            evaluate("(g 0.0)", env)
+            self.assertEqual(str(g([-0.0], env)), '-0.0')
+            # unhashable arguments are evaluated without the memo
+            self.assertEqual(Lambda(['x'], '(* x 2)').evaluate([[1]], {}), [1, 1])
+            # bodies which refer to globals or call other functions aren't memoized
+            for src in ("(define (g x) (+ x a))", "(define (h x) (f x x))", 
+                        "(define (k x) (define y x))"):
+                self.assertIsNone(evaluate(src, env).memo)
+        finally:
+            scheme.MEMOIZE = False
+
+    def test_deep_calls(self):
+        import sys
+        from .compiler import compile, compile_to_bc
+        from .scheme import run
+        # calls nested deeper than python's own recursion limit
+        depth = sys.getrecursionlimit() + 100
+        src = "(define (f0 x) (+ x 1)) " + " ".join(
+                f"(define (f{i} x) (f{i-1} x))" for i in range(1, depth))
+        env = {}
+        run(compile_to_bc(compile(src)), env)
+        self.assertEqual(run(compile_to_bc(compile(f"(f{depth-1} 1)")), env), 2)
+
+    def test_scope(self):
+        from .scheme import evaluate
+        env = {}
+        # free variables are looked up in the caller's environment
+        evaluate("(define (g y) x)", env)
+        evaluate("(define (f x) (g 0))", env)
+        self.assertEqual(evaluate("(f 3)", env), 3)
+        evaluate("(define (h x) (+ (define x 2) x))", env)
+        self.assertEqual(evaluate("(h 5)", env), 4)
+        self.assertNotIn('x', env)
+
+class TestCompile(unittest.TestCase):
+
+    def test_read_from(self):
+        from .compiler import tokenize, read_from
+        self.assertEqual(tokenize('(+ 2(f "a"))'), 
+                         [('(', '('), ('builtin', '+'), ('num', 2), ('(', '('), ('sym', 'f'), 
+                          ('str', 'a'), (')', ')'), (')', ')')])
+        tests = [('', []), ('2 a', [('num', 2), ('sym', 'a')]), ('()', [[]]),
+                 ('(+ 2 (* 3 x))', [[('builtin', '+'), ('num', 2), 
+                                     [('builtin', '*'), ('num', 3), ('sym', 'x')]]])]
+        for src, exps in tests:
+            self.assertEqual(read_from(tokenize(src)), exps)
+        bad_expressions = ['(', ')', '()(2']
+        for e in bad_expressions:
+            with self.assertRaises(SyntaxError):
+                read_from(tokenize(e))
+
+    def test_compile(self):
+        from .compiler import compile, compile_to_bc
+        from .scheme import run
+        tests = [('2', ('num', 2)),
+                 ('"bob"', ('str', 'bob')),
+                 ('a', ('global', 'a')),
+                 ('(+ a 2.5)', ('call', ('builtin', '+'), (('global', 'a'), ('num', 2.5)))),
+                 ('(define b 5)', ('define', 'b', ('num', 5))),
+                 ('(define (f x) (* x 2))',
+                    ('define', 'f', ('lambda', ('x',), 
+                        ('call', ('builtin', '*'), (('local', 0), ('num', 2)))))),
+                 ('1 2', ('seq', (('num', 1), ('num', 2)))),
+                 ]
+        for src, node in tests:
+            self.assertEqual(compile(src), node)
+
+        self.assertEqual(compile('(+ x y)', ('x',)),
+                         ('call', ('builtin', '+'), (('local', 0), ('global', 'y'))))
+        # redefined arguments keep their slot; the frame rebinds the slot itself
+        env = {}
+        run(compile_to_bc(compile('(define (f x) (+ ((define (x y) (* y 10)) 0) (x 2)))')), env)
+        self.assertEqual(run(compile_to_bc(compile('(f 1)')), env), 20)
+        # define is a value, so rebinding can't be spotted in the source
+        run(compile_to_bc(compile('(define d define) (define (g x) (+ (d "x" 7) x))')), env)
+        self.assertEqual(run(compile_to_bc(compile('(g 5)')), env), 14)
+        args = [5]
+        self.assertEqual(env['g'].evaluate(args, env), 14)
+        self.assertEqual(args, [5])
+
+        bad_expressions = ['(define + 3)', '(define 2 3)', '(define (f 2) 3)', '(define a)', '(+ 2']
+        for e in bad_expressions:
+            with self.assertRaises(SyntaxError):
+                compile(e)
+
+    def test_quicken_call(self):
+        from .compiler import compile, compile_to_bc
+        from .opcodes import CALL, CALL_LAMBDA
+        from .scheme import run
+        env = {}
+        run(compile_to_bc(compile("(define (f x) (+ x 1))")), env)
+        code = compile_to_bc(compile("(g 2)"))
+        env['g'] = env['f']
+        self.assertEqual(run(code, env), 3)
+        self.assertEqual(code.ops[-3], CALL_LAMBDA)
+        self.assertEqual(run(code, env), 3)
+        # a call site which stops seeing lambdas falls back to the generic CALL
+        env['g'] = 7
+        self.assertEqual(run(code, env), 2)
+        self.assertEqual(code.ops[-3], CALL)
+
+    def test_compile_memoized(self):
+        from .compiler import compile
+        self.assertIs(compile("(+ x 2)"), compile("(+ x 2)"))
+
+    def test_compile_cached_on_disk(self):
+        import os
+        import sys
+        import tempfile
+        from . import compiler
+        from .scheme import run
+        with tempfile.TemporaryDirectory() as d:
+            cache_dir, compiler.CACHE_DIR = compiler.CACHE_DIR, d
+            max_entries = compiler.CACHE_MAX_ENTRIES
+            prune_interval = compiler.CACHE_PRUNE_INTERVAL
+            try:
+                src = "(define (f value) (* value 3)) (f 2)"
+                code = compiler.compile_cached(src)
+                self.assertEqual(len(os.listdir(d)), 1)
+                compiler.compile_cached.cache_clear()
+                cached = compiler.compile_cached(src)
+                self.assertIsNot(cached, code)
+                self.assertEqual(list(cached.ops), list(code.ops))
+                self.assertEqual(run(cached, {}), 6)
+                # names loaded from disk are interned again
+                args, body = cached.consts[0]
+                self.assertIs(args[0], sys.intern(''.join(['val', 'ue'])))
+                # unreadable entries are recompiled
+                for name in os.listdir(d):
+                    with open(os.path.join(d, name), 'wb') as f:
+                        f.write(b'not a pickle')
+                compiler.compile_cached.cache_clear()
+                self.assertEqual(run(compiler.compile_cached(src), {}), 6)
+                compiler.CACHE_MAX_ENTRIES = 1
+                compiler.CACHE_PRUNE_INTERVAL = 2
+                compiler._writes_since_prune = 0
+                compiler.compile_cached("(+ 1 2)")
+                self.assertEqual(len(os.listdir(d)), 2)
+                compiler.compile_cached("(+ 1 3)")
+                self.assertEqual(len(os.listdir(d)), 1)
+            finally:
+                compiler.CACHE_DIR = cache_dir
+                compiler.CACHE_MAX_ENTRIES = max_entries
+                compiler.CACHE_PRUNE_INTERVAL = prune_interval
+                compiler.compile_cached.cache_clear()
+
+    def test_compile_to_bc(self):
+        from .compiler import compile, compile_to_bc
+        from .opcodes import LOAD_CONST, ADD, RET
+        from .scheme import sub
+        code = compile_to_bc(compile("(+ 1 2)"))
+        self.assertEqual(code.consts, [1, 2])
+        self.assertEqual(list(code.ops), [LOAD_CONST, 0, LOAD_CONST, 1, ADD, 2, RET])
+        # a single word in parentheses is not a call
+        code = compile_to_bc(compile("(-)"))
+        self.assertEqual(list(code.ops), [LOAD_CONST, 0, RET])
+        self.assertEqual(code.consts, [sub])
+
+    def test_superinstructions(self):
+        from .compiler import compile, compile_to_bc
+        from .opcodes import ADD_LOCAL_CONST, MUL_LOCAL_CONST, SUB_LOCAL_LOCAL, RET
+        from .scheme import run
+        tests = [("(+ x 2)", ADD_LOCAL_CONST, 7), ("(* 2 x)", MUL_LOCAL_CONST, 10),
+                 ("(- x y)", SUB_LOCAL_LOCAL, 2)]
+        for src, op, res in tests:
+            code = compile_to_bc(compile(src, ('x', 'y')))
+            self.assertEqual(code.ops[0], op)
+            self.assertEqual(len(code.ops), 4)
+            self.assertEqual(run(code, {}, [5, 3]), res)
+        # constants can't be moved before the argument for -
+        code = compile_to_bc(compile("(- 2 x)", ('x',)))
+        self.assertEqual(run(code, {}, [5]), -3)
+        code = compile_to_bc(compile("(+ x y)", ('x', 'y')))
+        with self.assertRaises(TypeError):
+            run(code, {}, ['a', 'b'])
+        # same signed zero as the generic SUB
+        code = compile_to_bc(compile("(- x y)", ('x', 'y')))
+        self.assertEqual(str(run(code, {}, [-0.0, -0.0])), '-0.0')
+        self.assertEqual(str(run(compile_to_bc(compile("(- m m)")), {'m': -0.0})), '-0.0')
+
+    def test_run(self):
+        from .compiler import compile, compile_to_bc
+        from .scheme import run, add
+        env = {}
+        double = run(compile_to_bc(compile("(define (double x) (* x 2))")), env)
+        self.assertEqual(run(compile_to_bc(compile("(double (+ 1 2))")), env), 6)
+        self.assertEqual(run(compile_to_bc(compile("1 (4) ()")), env), None)
+        self.assertEqual(run(compile_to_bc(compile("(double 1) (4)")), env), 4)
+        self.assertIs(run(compile_to_bc(compile("(+)")), env), add)
+        self.assertIs(run(compile_to_bc(compile("(double)")), env), double)
+        tests = [("(+ 1 2 3)", 6), ("(- 5)", 5), ("(- 5 1 2)", 2),
+                 ("(* 2 3 4)", 24), ("(* (+ 1 1) (- 4 1))", 6)]
+        for src, res in tests:
+            self.assertEqual(run(compile_to_bc(compile(src)), env), res)
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file